@@ -1,51 +1,213 @@
 """Script for starting the Frame Splitter server."""
 
+import io
 import json
 import logging
 import os
+import queue
+import tarfile
+import threading
+from collections import deque
 from io import BytesIO
 
+# Let FFmpeg decode with multiple threads. This has to be set before cv2 is imported, since the
+# FFmpeg backend reads it when the capture is created. Can be overridden from the container env.
+os.environ.setdefault("OPENCV_FFMPEG_CAPTURE_OPTIONS", "threads;8")
+
 import boto3
+import botocore.config
 import cv2
+import numpy as np
+
+import multiprocessing
 
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import requests
+from cachetools import TTLCache
 from flask import Flask, request, jsonify, current_app
 
+# libjpeg-turbo is noticeably faster than OpenCV's encoder and releases the GIL during the C
+# call, so the encoder pool can actually use multiple cores. Fall back to cv2.imencode when the
+# library isn't available (import fails if either the package or libturbojpeg is missing).
+try:
+    from turbojpeg import TurboJPEG
+    turbo_jpeg = TurboJPEG()
+except Exception:
+    turbo_jpeg = None
+
+# numba compiles the scoreboard-differencing kernel to parallel machine code; without it the
+# same computation falls back to vectorized numpy.
+try:
+    import numba
+except Exception:
+    numba = None
+
 app = Flask(__name__)
 app.logger.setLevel(logging.DEBUG)  # Set the logging level to debug
 
-# the executor pool used by the splitting endpoint
-executor = ThreadPoolExecutor(2)
+# long-lived boto3 clients, created once per process so the TLS handshake isn't paid per
+# request. The S3 connection pool is sized to the upload fan-out; the default of 10 connections
+# would serialize concurrent PUTs beyond that.
+s3_client = boto3.client('s3', config=botocore.config.Config(
+    max_pool_connections=64,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    tcp_keepalive=True))
+eventbridge_client = boto3.client('events', region_name='eu-north-1')
+
+# the executor pool used by the splitting endpoint. A split is CPU-bound through the whole
+# video, so each one runs in its own process with its own GIL and FFmpeg; workers are sized at a
+# quarter of the cores because each split uses multiple decode threads internally. The spawn
+# context keeps children from inheriting the parent's boto3 clients and thread pools, which are
+# not fork-safe.
+executor = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // 4),
+                               mp_context=multiprocessing.get_context("spawn"))
+
+# small thread pool for light background tasks, like the SNS subscription confirmation
+background_executor = ThreadPoolExecutor(2)
+
+# the shared pool for frame uploads. S3 PUTs are latency-bound, so many of them are kept in
+# flight at once; sharing one pool across requests reuses the HTTPS connections.
+upload_pool = ThreadPoolExecutor(32)
+
+# how many frame uploads may be in flight before the submitting thread waits for the oldest one
+MAX_UPLOADS_IN_FLIGHT = 64
+
+# quality of the JPEG encoding of the uploaded frames
+JPEG_QUALITY = 85
+
+# when > 0, frames are grouped into tar archives of this many frames and each archive is
+# uploaded as a single object ({game_id}/shard_{n}.tar). S3 PUT latency and cost are per
+# object, so sharding cuts both by the shard size; downstream consumers have to unpack the
+# shards. 0 (the default) uploads one object per frame.
+FRAMES_PER_SHARD = int(os.environ.get("FRAMES_PER_SHARD", "0"))
+
+# the region of a 1080p broadcast frame holding the score overlay, as (rows, columns) slices
+_SCOREBOARD_ROI = (slice(900, 1000), slice(50, 400))
+
+# mean absolute pixel difference in the scoreboard region above which a frame counts as a score
+# change. When > 0, only frames where the scoreboard changed are uploaded, which drops almost
+# everything during dead-ball periods. 0 (the default) disables the filter.
+SCOREBOARD_DIFF_THRESHOLD = float(os.environ.get("SCOREBOARD_DIFF_THRESHOLD", "0"))
+
+# frames whose dHash is within this Hamming distance of the previously kept frame are skipped.
+# Consecutive broadcast frames are near-identical during pauses and replays, so this cuts a large
+# share of the uploads. Off by default (0) like the other output-changing filters, since enabling
+# it changes what downstream consumers receive; 5 is a sensible starting threshold.
+FRAME_DEDUP_THRESHOLD = int(os.environ.get("FRAME_DEDUP_THRESHOLD", "0"))
+
+# pool of reusable buffers for the JPEG-encoded frames, so the pipeline doesn't allocate and
+# free a fresh multi-hundred-KB buffer for every one of the 100k+ frames in a match. Taking a
+# buffer blocks when the pool is empty, which also acts as backpressure on the encode stage.
+_BUFFER_POOL_SIZE = 64
+_BUFFER_SIZE = 1 << 20
+buffer_pool = queue.Queue()
+for _ in range(_BUFFER_POOL_SIZE):
+    buffer_pool.put(bytearray(_BUFFER_SIZE))
+
+# download the multi-GB match video with concurrent 16 MB byte-range GETs; a single S3 GET is
+# capped by per-connection TCP throughput
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CONCURRENCY = 8
 
 # the futures store. If a game is currently being processed, it will be stored here in the meantime.
-futures = {}
+# Entries remove themselves as soon as processing finishes (see _split_video); the size bound and
+# TTL are a safety net so a future that never resolves can't leak memory in a long-running server.
+futures = TTLCache(maxsize=256, ttl=86400)
 
+# only every n-th frame of the video is kept. Downstream consumers don't need the full 30/60 FPS.
+FRAME_SAMPLE_EVERY = int(os.environ.get("FRAME_SAMPLE_EVERY", "1"))
 
-def confirm_subscription(request_header, request_data):
-    """Confirms the SNS subscription."""
-    if request_header.get('x-amz-sns-message-type') == 'SubscriptionConfirmation':
-        app.logger.info("Got request for confirming subscription")
-        app.logger.info(request_header)
-        # Extract the request data from the POST body
+# bound on the queues between the decode, encode and upload stages, to cap how many raw frames
+# are held in memory at once.
+FRAME_QUEUE_SIZE = 32
 
-        subscribe_url = request_data['SubscribeURL']
+# how many decoded frames are handed to an encoder worker at once. A freshly decoded 1080p
+# frame is ~6MB; encoding a small batch right after decode works on data that is still warm in
+# cache instead of having every frame round-trip through DRAM.
+DECODE_BATCH_SIZE = 4
+
+# sentinel signalling the end of a pipeline stage
+_END_OF_STREAM = object()
+
+# at or above this sampling stride, seeking the capture straight to each kept frame is cheaper
+# than grab()-ing through all the skipped ones
+_SEEK_SAMPLE_THRESHOLD = 30
+
+# decode on the GPU (NVDEC) when OpenCV was built with cv2.cudacodec and a CUDA device is
+# present; set GPU_DECODE=0 to force CPU decode
+GPU_DECODE = os.environ.get("GPU_DECODE", "1") != "0"
+
+
+class BufferIO(io.RawIOBase):
+    """Minimal read-only file object over a bytes-like buffer.
+
+    io.BytesIO copies the data it is constructed with; this wrapper just keeps a memoryview
+    into the original buffer, so readers consume it without an extra copy.
+    """
 
-        # Make an HTTP GET request to the SubscribeURL to confirm the subscription
-        # This confirms the subscription with Amazon SNS
-        # You can use any HTTP library of your choice (e.g., requests)
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._pos = 0
 
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        num_bytes = min(len(b), len(self._view) - self._pos)
+        b[:num_bytes] = self._view[self._pos:self._pos + num_bytes]
+        self._pos += num_bytes
+        return num_bytes
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = pos
+        elif whence == io.SEEK_CUR:
+            self._pos += pos
+        else:
+            self._pos = len(self._view) + pos
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+def _confirm_subscription_url(subscribe_url: str):
+    """Performs the GET request to the SNS subscribe URL. Runs on the background executor.
+
+    :arg
+        subscribe_url (str): the SubscribeURL from the SNS confirmation message.
+    """
+    try:
         app.logger.info(f"Going to URL: {subscribe_url} to confirm the subscription.")
         response = requests.get(subscribe_url)
 
         if response.status_code == 200:
             app.logger.info(f"Subscription confirmed. Code: {response.status_code}.")
-            return jsonify({'message': 'SubscriptionConfirmed'})
         else:
             app.logger.warning(f"Failed to confirmed subscription. Code {response.status_code}.")
-            return jsonify({'message': 'Failed to confirm subscription'}), 500
+    except Exception as e:
+        app.logger.warning(f"Could not confirm subscription at {subscribe_url}.", exc_info=e)
+
+
+def confirm_subscription(request_header, request_data):
+    """Confirms the SNS subscription."""
+    if request_header.get('x-amz-sns-message-type') == 'SubscriptionConfirmation':
+        app.logger.info("Got request for confirming subscription")
+        app.logger.info(request_header)
+        # Extract the request data from the POST body
+
+        subscribe_url = request_data['SubscribeURL']
+
+        # Confirm in the background: SNS only needs the 200 response now, and the subscribe-URL
+        # GET can happen any time within the confirmation window without blocking this thread.
+        background_executor.submit(_confirm_subscription_url, subscribe_url)
+
+        return jsonify({'message': 'SubscriptionConfirmationInProgress'})
 
     return jsonify({"message": "Header does not contain 'x-amz-sns-message-type': 'SubscriptionConfirmation'. No "
                                "subscription to confirm."}), 500
@@ -59,7 +221,6 @@ def emit_num_frames_event(game_id: str, num_frames: int):
         num_frames (int): the number of frames to be placed inside the event.
 
     """
-    eventbridge_client = boto3.client('events', region_name='eu-north-1')
     event_data = {
         "game-id": game_id,
         "num-frames": num_frames
@@ -82,28 +243,14 @@ def emit_num_frames_event(game_id: str, num_frames: int):
         app.logger.warning(f"Could not emit event.", exc_info=e)
 
 
-def delete_local_frame(frame_path: str):
-    """Deletes the local version of the frame.
-
-    :arg
-        frame_path (str): the path to the frame.
-    """
-    try:
-        app.logger.info(f"Deleting local version of frame from {frame_path}.")
-        os.remove(frame_path)
-        app.logger.info(f"File {frame_path} successfully deleted.")
-    except OSError as e:
-        app.logger.warning(f"Could not delete local frame {frame_path}.", exc_info=e)
-
-
-def upload_frame(s3_client, frame_path: str, bucket_name: str, frame_object_key: str, game_id: str):
-    """Uploads a frame to the specified bucket with the given object key.
+def upload_frame(s3_client, frame_bytes, bucket_name: str, frame_object_key: str, game_id: str):
+    """Uploads a JPEG-encoded frame to the specified bucket with the given object key.
 
     :arg
         s3_client: the boto3 s3 client object.
-        frame: a CV2 frame.
+        frame_bytes: the JPEG-encoded frame bytes (any bytes-like object, including memoryviews).
         bucket_name (str): the bucket to which to upload the frame.
-        object_key (str): the name of the frame in the bucket.
+        frame_object_key (str): the name of the frame in the bucket.
         game_id (str): the ID of the game that the frame belongs to.
 
     :return
@@ -114,7 +261,10 @@ def upload_frame(s3_client, frame_path: str, bucket_name: str, frame_object_key:
     app.logger.info(f"Uploading {frame_object_key} to {bucket_name}.")
 
     try:
-        s3_client.upload_file(frame_path, bucket_name, frame_object_key, ExtraArgs={"Metadata": metadata})
+        # botocore only accepts bytes, bytearray or a file-like object as the body, not a
+        # memoryview; BufferIO exposes any bytes-like object as a file without copying it
+        s3_client.put_object(Bucket=bucket_name, Key=frame_object_key, Body=BufferIO(frame_bytes),
+                             ContentLength=len(frame_bytes), Metadata=metadata)
         return True
     except Exception as e:
         app.logger.warning(f"Could not upload frame {frame_object_key} to bucket {bucket_name}.", exc_info=e)
@@ -122,12 +272,162 @@ def upload_frame(s3_client, frame_path: str, bucket_name: str, frame_object_key:
     return False
 
 
-def get_frames(video_path: str):
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _roi_abs_diff(prev_roi, cur_roi):
+        flat_prev = prev_roi.ravel()
+        flat_cur = cur_roi.ravel()
+        total = 0
+        for i in numba.prange(flat_prev.size):
+            # cast to signed explicitly: numba types int() on a uint8 as uint8, so the
+            # subtraction would wrap around instead of going negative
+            diff = np.int64(flat_prev[i]) - np.int64(flat_cur[i])
+            total += diff if diff >= 0 else -diff
+        return total
+else:
+    def _roi_abs_diff(prev_roi, cur_roi):
+        return int(np.sum(np.abs(prev_roi.astype(np.int32) - cur_roi.astype(np.int32))))
+
+
+def scoreboard_changed(prev_roi, cur_roi, threshold: float):
+    """Checks whether the scoreboard region changed between two frames.
+
+    Computes the sum of absolute pixel differences over the region and compares the per-pixel
+    mean against the threshold.
+
+    :arg
+        prev_roi: the scoreboard crop of the previously kept frame.
+        cur_roi: the scoreboard crop of the current frame.
+        threshold (float): the mean absolute difference above which the region counts as changed.
+
+    :return
+        (bool) true if the region changed.
+    """
+    # the ROI is cut for 1080p broadcasts; on smaller frames the crop is empty, so keep the
+    # frame rather than crash the decode stage
+    if prev_roi.size == 0:
+        app.logger.warning("Scoreboard region is empty for this source; keeping the frame.")
+        return True
+
+    return _roi_abs_diff(prev_roi, cur_roi) / prev_roi.size > threshold
+
+
+def frame_dhash(frame):
+    """Computes a 64-bit difference hash (dHash) of the frame.
+
+    The frame is downscaled to 9x8 grayscale and the sign bits of adjacent-pixel differences are
+    packed into an integer. Near-identical frames end up a few bits apart at most.
+
+    :arg
+        frame: a CV2 frame.
+
+    :return
+        (int): the 64-bit hash.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    diff_bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(diff_bits).tobytes(), 'big')
+
+
+def encode_frame(frame):
+    """JPEG-encodes a frame, preferring libjpeg-turbo when it is available.
+
+    :arg
+        frame: a CV2 frame.
+
+    :return
+        the encoded bytes-like object, or None if encoding failed.
+    """
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(frame, quality=JPEG_QUALITY)
+
+    ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buf if ok else None
+
+
+def _gpu_decode_available():
+    """Checks whether GPU video decode through cv2.cudacodec can be used.
+
+    :return
+        (bool) true if a CUDA device is present and OpenCV was built with the cudacodec module.
+    """
+    if not GPU_DECODE:
+        return False
+    try:
+        return hasattr(cv2, 'cudacodec') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except Exception:
+        return False
+
+
+def _get_frames_gpu(video_path: str, sample_every: int):
+    """Generator for frames decoded on the GPU with NVDEC via cv2.cudacodec.
+
+    Frames are decoded into VRAM; only the kept ones are downloaded to host memory.
+
+    :arg
+        video_path (str): the path or URL of the video from which to get the frames.
+        sample_every (int): yield every n-th frame; 1 yields all frames.
+    """
+    reader = cv2.cudacodec.createVideoReader(video_path)
+
+    # NVDEC surfaces come back BGRA (4-channel) by default, while everything downstream — the
+    # dHash, the scoreboard crop, the JPEG encoders — assumes 3-channel BGR; ask the reader for
+    # BGR, and convert after download on builds where the setting isn't supported
+    try:
+        reader.set(cv2.cudacodec.ColorFormat.BGR)
+    except (cv2.error, AttributeError):
+        pass
+
+    frame_index = 0
+    while True:
+        ret, gpu_frame = reader.nextFrame()
+
+        # Break the loop if no more frames are available
+        if not ret:
+            break
+
+        # Only download the frames we actually keep
+        if frame_index % sample_every == 0:
+            frame = gpu_frame.download()
+            if frame.ndim == 3 and frame.shape[2] == 4:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+            yield frame
+
+        frame_index += 1
+
+
+def get_frames(video_path: str, sample_every: int = 1):
     """Generator for the frames at the provided path.
 
+    When OpenCV has CUDA support and a GPU is present, frames are decoded with the hardware
+    NVDEC decoder and the CPU path below is skipped entirely.
+
+    Frames are advanced with `cap.grab()`, which only moves the stream pointer, and are fully
+    decoded with `cap.retrieve()` for every `sample_every`-th frame. Skipped frames never go
+    through the expensive decode and color-conversion step. For very sparse sampling the capture
+    instead seeks straight to each kept frame, which skips even the bitstream parse of the
+    frames in between (the codec still decodes from the nearest keyframe).
+
     :arg
-        video_path (str): the path to the video from which to get the frames.
+        video_path (str): the path or URL of the video from which to get the frames.
+        sample_every (int): yield every n-th frame; 1 yields all frames.
     """
+    if _gpu_decode_available():
+        yielded_any = False
+        try:
+            for frame in _get_frames_gpu(video_path, sample_every):
+                yielded_any = True
+                yield frame
+            return
+        except cv2.error as e:
+            if yielded_any:
+                # restarting on the CPU would re-yield already-processed frames under
+                # duplicate keys; let the pipeline fail the split instead
+                app.logger.error(f"GPU decode failed mid-stream for {video_path}.", exc_info=e)
+                raise
+            app.logger.warning(f"GPU decode failed for {video_path}, falling back to CPU decode.", exc_info=e)
+
     # Open the video file
     cap = cv2.VideoCapture(video_path)
 
@@ -135,75 +435,290 @@ def get_frames(video_path: str):
     if not cap.isOpened():
         app.logger.error(f"Could not open video file: {video_path}")
 
-    # Loop through the frames
-    while True:
-        ret, frame = cap.read()
+    # the seek path needs a frame count, which some sources (e.g. HTTP streams) don't report;
+    # for those the dense grab()/retrieve() loop below still works
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) if sample_every >= _SEEK_SAMPLE_THRESHOLD else 0
 
-        # Break the loop if no more frames are available
-        if not ret:
-            break
+    if total_frames > 0:
+        # sparse sampling: seek to each kept frame
+        for target_frame in range(0, total_frames, sample_every):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+            ret, frame = cap.read()
 
-        yield frame
+            # Break the loop if no more frames are available
+            if not ret:
+                break
+
+            yield frame
+    else:
+        # dense sampling: loop through the frames
+        frame_index = 0
+        while True:
+            # Break the loop if no more frames are available
+            if not cap.grab():
+                break
+
+            # Only fully decode the frames we actually keep
+            if frame_index % sample_every == 0:
+                ret, frame = cap.retrieve()
+                if ret:
+                    yield frame
+
+            frame_index += 1
 
     # Release the video capture object
     cap.release()
 
 
-def split_video(bucket, object_key):
+def download_video(bucket, object_key, video_path: str):
+    """Downloads the video to local disk using concurrent byte-range GETs.
+
+    The object size is read with head_object, the target file is preallocated, and fixed-size
+    ranges are fetched in parallel and written straight to their known offsets with os.pwrite.
+
+    :arg
+        bucket (str): the name of the bucket where to find the video.
+        object_key (str): the object key of the video in the bucket.
+        video_path (str): the local path to download the video to.
+    """
+    video_size = s3_client.head_object(Bucket=bucket, Key=object_key)['ContentLength']
+
+    fd = os.open(video_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+    try:
+        os.posix_fallocate(fd, 0, video_size)
+
+        def fetch_range(offset):
+            last_byte = min(offset + DOWNLOAD_CHUNK_SIZE, video_size) - 1
+            response = s3_client.get_object(Bucket=bucket, Key=object_key,
+                                            Range=f"bytes={offset}-{last_byte}")
+            os.pwrite(fd, response['Body'].read(), offset)
+
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as download_pool:
+            fetch_futures = [download_pool.submit(fetch_range, offset)
+                             for offset in range(0, video_size, DOWNLOAD_CHUNK_SIZE)]
+            for fetch_future in fetch_futures:
+                fetch_future.result()
+    finally:
+        os.close(fd)
+
+
+def split_video(bucket, object_key, game_id):
     """Splits the video located at the bucket and object location into frames and uploads the frames to S3.
 
-    All frames are saved to local storage as an intermediate step, and are deleted afterwards if they upload to S3 bucket
-    is successful.
+    Frames are JPEG-encoded in memory and uploaded straight from there; they never touch local storage.
 
     :arg
         bucket (str): the name of the bucket where to find the video.
         object_key (str): the object key of the video in the bucket.
+        game_id (str): the ID of the game the video belongs to.
 
     :return
         (int): the number of frames uploaded.
     """
-    video_dir = "temp-video"
-    Path(video_dir).mkdir(parents=True, exist_ok=True)
-    video_path = f"{video_dir}/{object_key}"
+    # Decode straight from S3 where possible: the FFmpeg backend accepts HTTP(S) URLs, so with a
+    # presigned GET the decode starts on the first received bytes, overlaps with the transfer,
+    # and nothing is staged on local disk.
+    video_source = s3_client.generate_presigned_url(
+        'get_object', Params={'Bucket': bucket, 'Key': object_key}, ExpiresIn=3600)
+
+    app.logger.info(f"Probing streaming decode of Object: {object_key} from Bucket: {bucket}.")
+    probe = cv2.VideoCapture(video_source)
+    streamable = probe.isOpened()
+    probe.release()
+
+    if not streamable:
+        # fall back to downloading the whole video to local disk first
+        app.logger.warning(f"Could not open {object_key} for streaming, downloading it instead.")
 
-    # download object
-    s3 = boto3.client('s3')
+        video_dir = "temp-video"
+        Path(video_dir).mkdir(parents=True, exist_ok=True)
+        video_source = f"{video_dir}/{object_key}"
 
-    app.logger.info(f"Downloading Object: {object_key} from Bucket: {bucket}.")
+        app.logger.info(f"Downloading Object: {object_key} from Bucket: {bucket}.")
 
-    with open(video_path, 'wb') as file:
-        s3.download_fileobj(bucket, object_key, file)
+        download_video(bucket, object_key, video_source)
         app.logger.info("Download successful.")
 
-    game_id = object_key.split(".")[0]
-    frame_dir = f"frames/{game_id}"
-    Path(frame_dir).mkdir(parents=True, exist_ok=True)
     bucket_name = "nba-match-frames"
 
-    frame_count = 0
-
     app.logger.info("Going through frames of the video.")
 
-    for frame in get_frames(video_path):
-
-        frame_count += 1
-        frame_name = f"frame_{frame_count:04d}.jpg"
-
-        local_frame_path = f'{frame_dir}/{frame_name}'
-        cv2.imwrite(local_frame_path, frame)
+    # The pipeline has three stages connected by bounded queues: one thread decodes frames, a pool
+    # of workers JPEG-encodes them, and this thread uploads the results. Decode and encode are
+    # CPU-bound while upload is network-bound, so overlapping them keeps all three busy.
+    # the raw-frame queue holds batches, so its bound is scaled down to keep the same cap on
+    # frames held in memory
+    frame_queue = queue.Queue(maxsize=max(1, FRAME_QUEUE_SIZE // DECODE_BATCH_SIZE))
+    encoded_queue = queue.Queue(maxsize=FRAME_QUEUE_SIZE)
+    num_encoders = os.cpu_count() or 1
 
-        # save the frame in a folder named after the game name
-        frame_object_key = f"{game_id}/{frame_name}"
+    # failures in the decode or encode stage land here and are re-raised once the pipeline has
+    # drained, so a broken stage fails the split instead of silently dropping frames
+    stage_errors = []
 
-        if upload_frame(s3, local_frame_path, bucket_name, frame_object_key, game_id):
-            delete_local_frame(local_frame_path)
+    def decode_frames():
+        try:
+            frame_count = 0
+            prev_hash = None
+            prev_scoreboard = None
+            batch = []
+            for frame in get_frames(video_source, sample_every=FRAME_SAMPLE_EVERY):
+                # skip frames that are near-identical to the previously kept one
+                if FRAME_DEDUP_THRESHOLD > 0:
+                    frame_hash = frame_dhash(frame)
+                    if prev_hash is not None and bin(prev_hash ^ frame_hash).count('1') < FRAME_DEDUP_THRESHOLD:
+                        continue
+                    prev_hash = frame_hash
+
+                # when the scoreboard filter is on, only keep frames where the score overlay changed
+                if SCOREBOARD_DIFF_THRESHOLD > 0:
+                    scoreboard = frame[_SCOREBOARD_ROI]
+                    if prev_scoreboard is not None and not scoreboard_changed(
+                            prev_scoreboard, scoreboard, SCOREBOARD_DIFF_THRESHOLD):
+                        continue
+                    prev_scoreboard = scoreboard.copy()
+
+                frame_count += 1
+                batch.append((frame_count, frame))
+
+                if len(batch) == DECODE_BATCH_SIZE:
+                    frame_queue.put(batch)
+                    batch = []
+
+            if batch:
+                frame_queue.put(batch)
+        except Exception as e:
+            app.logger.error(f"Decode stage failed for {object_key}.", exc_info=e)
+            stage_errors.append(e)
+        finally:
+            # always release the encoder workers: one sentinel each, so they all shut down
+            for _ in range(num_encoders):
+                frame_queue.put(_END_OF_STREAM)
+
+    def encode_frames():
+        while True:
+            batch = frame_queue.get()
+            if batch is _END_OF_STREAM:
+                break
+
+            # encode the whole batch in this worker while the frames are still warm in cache
+            for frame_count, frame in batch:
+                try:
+                    encoded = encode_frame(frame)
+                except Exception as e:
+                    app.logger.warning(f"Could not encode frame {frame_count}.", exc_info=e)
+                    continue
+
+                if encoded is None:
+                    app.logger.warning(f"Could not encode frame {frame_count}.")
+                    continue
+
+                # copy the encoded frame into a pooled buffer; the upload stage returns it
+                num_bytes = len(encoded)
+                frame_buffer = buffer_pool.get()
+                if len(frame_buffer) < num_bytes:
+                    # rare oversized frame: grow the buffer, the bigger one goes back to the pool
+                    frame_buffer = bytearray(num_bytes)
+                frame_buffer[:num_bytes] = memoryview(encoded).cast('B')
+
+                # save the frame in a folder named after the game name
+                frame_object_key = f"{game_id}/frame_{frame_count:04d}.jpg"
+                encoded_queue.put((frame_buffer, num_bytes, frame_object_key))
+
+    def close_encoded_queue():
+        try:
+            # wait for every encoder before closing the queue: aborting on the first failure
+            # would strand the others on a full queue with nobody draining it
+            for encoder_future in encoder_futures:
+                try:
+                    encoder_future.result()
+                except Exception as e:
+                    app.logger.error(f"Encode stage failed for {object_key}.", exc_info=e)
+                    stage_errors.append(e)
+        finally:
+            encoded_queue.put(_END_OF_STREAM)
+
+    def upload_and_recycle(frame_buffer, num_bytes, frame_object_key):
+        try:
+            upload_frame(s3_client, memoryview(frame_buffer)[:num_bytes], bucket_name, frame_object_key, game_id)
+        finally:
+            buffer_pool.put(frame_buffer)
+
+    decoder = threading.Thread(target=decode_frames, daemon=True)
+    decoder.start()
+
+    with ThreadPoolExecutor(max_workers=num_encoders) as encode_pool:
+        encoder_futures = [encode_pool.submit(encode_frames) for _ in range(num_encoders)]
+        threading.Thread(target=close_encoded_queue, daemon=True).start()
+
+        frame_count = 0
+        upload_futures = deque()
+        shard_buffer = None
+        shard_tar = None
+        shard_count = 0
+        frames_in_shard = 0
+
+        def submit_shard():
+            shard_tar.close()
+            shard_key = f"{game_id}/shard_{shard_count:06d}.tar"
+            # getbuffer() hands out a view of the BytesIO contents without copying them;
+            # upload_frame wraps it in BufferIO since put_object won't take a raw memoryview
+            upload_futures.append(upload_pool.submit(
+                upload_frame, s3_client, shard_buffer.getbuffer(), bucket_name, shard_key, game_id))
+
+        while True:
+            item = encoded_queue.get()
+            if item is _END_OF_STREAM:
+                break
+
+            frame_buffer, num_bytes, frame_object_key = item
+            frame_count += 1
+
+            if FRAMES_PER_SHARD > 0:
+                # collect frames into a tar shard and upload it as one object
+                if shard_tar is None:
+                    shard_buffer = BytesIO()
+                    shard_tar = tarfile.open(fileobj=shard_buffer, mode='w')
+
+                tar_info = tarfile.TarInfo(name=frame_object_key.rsplit('/', 1)[-1])
+                tar_info.size = num_bytes
+                shard_tar.addfile(tar_info, BufferIO(memoryview(frame_buffer)[:num_bytes]))
+                buffer_pool.put(frame_buffer)
+                frames_in_shard += 1
+
+                if frames_in_shard == FRAMES_PER_SHARD:
+                    submit_shard()
+                    shard_count += 1
+                    frames_in_shard = 0
+                    shard_buffer = None
+                    shard_tar = None
+            else:
+                upload_futures.append(
+                    upload_pool.submit(upload_and_recycle, frame_buffer, num_bytes, frame_object_key))
+
+            # backpressure: once too many uploads are in flight, wait for the oldest one
+            if len(upload_futures) > MAX_UPLOADS_IN_FLIGHT:
+                upload_futures.popleft().result()
+
+        # upload the final partial shard
+        if frames_in_shard > 0:
+            submit_shard()
+
+        # wait for the remaining uploads
+        while upload_futures:
+            upload_futures.popleft().result()
+
+    # a failed stage means an unknown number of frames never made it out; fail the split rather
+    # than reporting the partial count as a success
+    if stage_errors:
+        raise stage_errors[0]
 
     app.logger.info(f"Uploaded {frame_count} frames to {bucket_name}.")
     return frame_count
 
 
 def split_and_emit(bucket, object_key, game_id):
-    frame_count = split_video(bucket, object_key)
+    frame_count = split_video(bucket, object_key, game_id)
     emit_num_frames_event(game_id, frame_count)
 
 
@@ -211,19 +726,17 @@ def _split_video(bucket, object_key):
     # the name of the video file is the game ID
     game_id = object_key.split(".")[0]
 
-    # if task is still running, ignore the request
-    if game_id in futures:
-        if not futures[game_id].done():
-            app.logger.info(f"The file {object_key} is already being processed.")
-            return jsonify({"message": "Game file is already being processed."}), 200
-        else:
-            app.logger.info(f"The file {object_key} finished processing.")
-            del futures[game_id]
+    # if task is still running, ignore the request. Finished futures remove themselves from the
+    # store, so presence here means the game is still being processed.
+    if game_id in futures and not futures[game_id].done():
+        app.logger.info(f"The file {object_key} is already being processed.")
+        return jsonify({"message": "Game file is already being processed."}), 200
 
     app.logger.info(f"Starting splitting of video {object_key}.")
 
     future = executor.submit(split_and_emit, bucket, object_key, game_id)
     futures[game_id] = future
+    future.add_done_callback(lambda _: futures.pop(game_id, None))
 
 
 @app.route('/health', methods=["GET"])
@@ -281,4 +794,5 @@ def hello_world():
 
 
 if __name__ == '__main__':
+    # local development only; the container runs the app under gunicorn with a gevent worker
     app.run(host='0.0.0.0', port=5000)